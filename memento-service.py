@@ -1,28 +1,46 @@
+import asyncio
+import json
 import logging
 import sys
+import os
 import os.path
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from hashlib import sha1, sha256
+from queue import Empty, Queue
+from threading import Lock, Thread
+import numpy as np
+import aiofiles
+import aiofiles.os
+import aiofiles.tempfile
 from llama_index.core import (
     VectorStoreIndex,
     SimpleDirectoryReader,
     StorageContext,
+    Settings,
     load_index_from_storage,
     
 )
 
 from llama_index.core.node_parser import SimpleNodeParser
+from llama_index.core.schema import MetadataMode, QueryBundle
 
 from typing import Union
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import HTMLResponse
+from fastapi import Body, FastAPI, File, UploadFile
+from fastapi.responses import HTMLResponse, ORJSONResponse
 
-#from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.embeddings.openai import OpenAIEmbedding
 
 from llama_index.core.retrievers import VectorIndexAutoRetriever
 from llama_index.core.vector_stores.types import MetadataInfo, VectorStoreInfo
 from fastapi.middleware.cors import CORSMiddleware
+import uvicorn
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -32,9 +50,15 @@ app.add_middleware(
     allow_headers=["*"],  # 모든 HTTP 헤더 허용
 )
 
-# logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-# logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
+# libraries (httpx, llama-index) stay at WARNING; LOG_LEVEL only applies to this service's logger
+logging.basicConfig(stream=sys.stdout, level=logging.WARNING)
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
 
+# send up to 256 chunks per embeddings request instead of the default 100
+EMBED_BATCH_SIZE = 256
+Settings.embed_model = OpenAIEmbedding(embed_batch_size=EMBED_BATCH_SIZE)
 
 PERSIST_DIR = "./storage"
 global index
@@ -51,10 +75,35 @@ else:
 global query_engine
 query_engine = index.as_query_engine()
 
-from fastapi import Body
+vector_store_info = VectorStoreInfo(
+    content_info="company documents",
+    metadata_info=[]
+    #     MetadataInfo(
+    #         name="category",
+    #         type="str",
+    #         description=(
+    #             "Category of the celebrity, one of [Sports, Entertainment,"
+    #             " Business, Music]"
+    #         ),
+    #     ),
+    #     MetadataInfo(
+    #         name="country",
+    #         type="str",
+    #         description=(
+    #             "Country of the celebrity, one of [United States, Barbados,"
+    #             " Portugal]"
+    #         ),
+    #     ),
+    # ],
+)
+
+global retriever
+retriever = VectorIndexAutoRetriever(
+    index, vector_store_info=vector_store_info
+)
 
 @app.post("/retrieve")
-def read_item(query: dict = Body(...)):
+async def read_item(query: dict = Body(...)):
     query_text = query.get("query", "")
 
     # embed_model = OpenAIEmbedding()
@@ -62,59 +111,188 @@ def read_item(query: dict = Body(...)):
 
     # response = index.query_vector_store(query_embedding, top_k=10)
 
-    vector_store_info = VectorStoreInfo(
-        content_info="company documents",
-        metadata_info=[]
-        #     MetadataInfo(
-        #         name="category",
-        #         type="str",
-        #         description=(
-        #             "Category of the celebrity, one of [Sports, Entertainment,"
-        #             " Business, Music]"
-        #         ),
-        #     ),
-        #     MetadataInfo(
-        #         name="country",
-        #         type="str",
-        #         description=(
-        #             "Country of the celebrity, one of [United States, Barbados,"
-        #             " Portugal]"
-        #         ),
-        #     ),
-        # ],
-    )
-    retriever = VectorIndexAutoRetriever(
-        index, vector_store_info=vector_store_info
-    )
-
-    response = retriever.retrieve(query_text)
+    response = await retriever.aretrieve(query_text)
 
-    print(type(response))
-    print(response)
+    logger.debug("Retrieved nodes: %s", response)
 
     return response
 
+# ---- answer cache for repeated and paraphrased queries ----
+QUERY_CACHE_SIZE = 256
+QUERY_CACHE_TTL = 600  # seconds
+# ada-002 similarities sit high even for unrelated text, so only near-paraphrases hit
+SEMANTIC_CACHE_THRESHOLD = 0.97
+
+query_cache = OrderedDict()
+query_cache_lock = Lock()
+# bumped on every clear, so answers computed against an older index are not cached
+query_cache_generation = 0
+
+def is_expired(cached_at):
+    return time.time() - cached_at > QUERY_CACHE_TTL
+
+def get_cached_response(query_text):
+    key = sha1(query_text.encode("utf-8")).hexdigest()
+    with query_cache_lock:
+        entry = query_cache.get(key)
+        if entry is None:
+            return None
+        cached_at, _, response = entry
+        if is_expired(cached_at):
+            del query_cache[key]
+            return None
+        query_cache.move_to_end(key)
+        return response
+
+def normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def get_similar_cached_response(query_embedding):
+    # snapshot under the lock, score outside it: cosine of unit vectors is one matrix-vector product
+    with query_cache_lock:
+        entries = [
+            (key, vector)
+            for key, (cached_at, vector, _) in query_cache.items()
+            if not is_expired(cached_at)
+        ]
+    if not entries:
+        return None
+    keys, vectors = zip(*entries)
+    scores = np.stack(vectors) @ normalize(query_embedding)
+    best = int(np.argmax(scores))
+    if scores[best] < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    with query_cache_lock:
+        entry = query_cache.get(keys[best])
+        if entry is None:
+            # cleared or evicted while scoring
+            return None
+        query_cache.move_to_end(keys[best])
+        return entry[2]
+
+def get_cache_generation():
+    with query_cache_lock:
+        return query_cache_generation
+
+def mark_cache_hit(response):
+    # tag a copy so the cached response itself keeps its original metadata
+    return replace(response, metadata={**(response.metadata or {}), "_cache": "hit"})
+
+def cache_response(query_text, query_embedding, response, generation):
+    key = sha1(query_text.encode("utf-8")).hexdigest()
+    vector = normalize(query_embedding)
+    with query_cache_lock:
+        if generation != query_cache_generation:
+            # the index changed while this answer was being built
+            return
+        query_cache[key] = (time.time(), vector, response)
+        query_cache.move_to_end(key)
+        while len(query_cache) > QUERY_CACHE_SIZE:
+            query_cache.popitem(last=False)
+
+def clear_query_cache():
+    global query_cache_generation
+    with query_cache_lock:
+        query_cache.clear()
+        query_cache_generation += 1
+
 @app.post("/query")
-def read_item(query: dict = Body(...)):
+async def read_item(query: dict = Body(...)):
     query_text = query.get("query", "")
-    response = query_engine.query(query_text)
+    use_cache = not query.get("no_cache", False)
+    generation = get_cache_generation()
+
+    if use_cache:
+        response = get_cached_response(query_text)
+        if response is not None:
+            logger.debug("Query cache hit: %s", query_text)
+            return mark_cache_hit(response)
+
+    # embed once: used for the semantic lookup and handed to the retriever
+    query_embedding = await Settings.embed_model.aget_query_embedding(query_text)
+
+    if use_cache:
+        response = get_similar_cached_response(query_embedding)
+        if response is not None:
+            logger.debug("Semantic query cache hit: %s", query_text)
+            return mark_cache_hit(response)
+
+    response = await query_engine.aquery(
+        QueryBundle(query_str=query_text, embedding=query_embedding)
+    )
+    if use_cache:
+        cache_response(query_text, query_embedding, response, generation)
 
-    print(type(response))
-    print(response.metadata)
-    print(response)
+    logger.debug("Query response: %s (metadata: %s)", response, response.metadata)
 
     return response
 
-import os
-import shutil
-
 drop_directory = "./drop"
+# uploads are written here first; inside the drop directory (one volume) so moving a file in is a
+# rename, and the indexer skips it since list_files ignores directories and the observer is not recursive
+staging_directory = os.path.join(drop_directory, ".staging")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# sha256 of every indexed upload, so re-uploads are not embedded again
+UPLOAD_DIGESTS_FILE = os.path.join(PERSIST_DIR, "upload_digests.json")
+
+def load_upload_digests():
+    if not os.path.exists(UPLOAD_DIGESTS_FILE):
+        return set()
+    with open(UPLOAD_DIGESTS_FILE) as f:
+        return set(json.load(f))
+
+def save_upload_digests():
+    # write a sibling temp file and swap it in, so a crash never leaves a truncated file
+    with upload_digests_lock:
+        digests = sorted(upload_digests)
+    temp_path = UPLOAD_DIGESTS_FILE + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(digests, f)
+    os.replace(temp_path, UPLOAD_DIGESTS_FILE)
+
+upload_digests = load_upload_digests()
+# filename -> digest of uploads waiting in the drop directory; committed once indexed
+pending_uploads = {}
+upload_digests_lock = Lock()
 
 @app.post("/uploadfile/")
 async def create_upload_file(file: UploadFile = File(...)):
-    with open(f"{drop_directory}/{file.filename}", "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    return {"filename": file.filename}
+    # stage in a subdirectory the indexer ignores so it never sees a partial file
+    digest = sha256()
+    staged_path = None
+    try:
+        async with aiofiles.tempfile.NamedTemporaryFile(
+            "wb", dir=staging_directory, delete=False
+        ) as buffer:
+            staged_path = buffer.name
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                await buffer.write(chunk)
+        file_digest = digest.hexdigest()
+
+        with upload_digests_lock:
+            is_duplicate = file_digest in upload_digests
+            if not is_duplicate:
+                pending_uploads[file.filename] = file_digest
+        if is_duplicate:
+            return {"filename": file.filename, "cached": True}
+
+        # same filesystem, so the file appears in the drop directory whole or not at all
+        try:
+            await aiofiles.os.replace(staged_path, f"{drop_directory}/{file.filename}")
+        except Exception:
+            with upload_digests_lock:
+                pending_uploads.pop(file.filename, None)
+            raise
+        staged_path = None
+        return {"filename": file.filename}
+    finally:
+        # client disconnects, write errors and duplicates all leave a staged file behind
+        if staged_path is not None:
+            await aiofiles.os.remove(staged_path)
 
 @app.get("/")
 async def main():
@@ -138,61 +316,193 @@ async def main():
 #     return HTMLResponse(content=content)
 
 
-# ---- intervally search directory and indexing ----
-from threading import Thread
-import time
-
-def find_first_file(directory):
-    for file in os.listdir(directory):
-        if os.path.isfile(os.path.join(directory, file)):
-            return file
-    return None
+# ---- drop directory indexing ----
+def list_files(directory):
+    return [
+        os.path.join(directory, file)
+        for file in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, file))
+    ]
 
-def delete_all_files_in_directory(directory):
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
+def delete_files(file_paths):
+    for file_path in file_paths:
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.remove(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
+            os.remove(file_path)
         except Exception as e:
-            print('Failed to delete %s. Reason: %s' % (file_path, e))
-
-
-def index_periodically(directory, interval):
-    global query_engine
-    while True:
-        file_name = find_first_file(directory)
-        if file_name:
-            print(file_name)
-
-            documents = SimpleDirectoryReader(directory).load_data()
-            # new_index = VectorStoreIndex.from_documents(documents)
-            #     # store it for later
-            # new_index.storage_context.persist(persist_dir=PERSIST_DIR)
-                    
-            parser = SimpleNodeParser()
-            new_nodes = parser.get_nodes_from_documents(documents)
-
+            logger.warning('Failed to delete %s. Reason: %s', file_path, e)
+
+def file_snapshot(file_path):
+    # a same-name upload is swapped in with os.replace, so it always gets a new inode
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns)
+
+def claim_upload_digests(file_paths):
+    with upload_digests_lock:
+        return {
+            file_path: pending_uploads.pop(os.path.basename(file_path), None)
+            for file_path in file_paths
+        }
+
+def settle_upload_digests(digests, unchanged_paths, indexed):
+    # record what was indexed; after a failure drop the digests so the files can be uploaded again
+    with upload_digests_lock:
+        for file_path, digest in digests.items():
+            if digest is None:
+                continue
+            if file_path not in unchanged_paths:
+                # replaced during the pass; keep a digest pending for the next one
+                pending_uploads.setdefault(os.path.basename(file_path), digest)
+            elif indexed:
+                upload_digests.add(digest)
+    if indexed:
+        save_upload_digests()
+
+
+node_parser = SimpleNodeParser()
+
+def chunk_hash(node):
+    return sha256(node.get_content().encode("utf-8")).hexdigest()
+
+# content hashes of every chunk already in the index, so re-uploads skip re-embedding
+indexed_chunk_hashes = {chunk_hash(node) for node in index.docstore.docs.values()}
+
+def filter_new_chunks(nodes):
+    new_chunks = {}
+    for node in nodes:
+        digest = chunk_hash(node)
+        if digest not in indexed_chunk_hashes and digest not in new_chunks:
+            new_chunks[digest] = node
+    return new_chunks
+
+EMBED_CONCURRENCY = 8
+
+async def aembed_texts(embed_model, texts):
+    # aget_text_embedding_batch already gathers its batches concurrently, unbounded; slicing
+    # here only exists to cap the requests in flight with the semaphore
+    batch_size = embed_model.embed_batch_size
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embed_model.aget_text_embedding_batch(batch)
+
+    results = await asyncio.gather(
+        *[embed_batch(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+    )
+    return [embedding for batch in results for embedding in batch]
+
+def embed_nodes(nodes):
+    # embed batches concurrently so insert_nodes does not embed them one batch at a time
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    # each asyncio.run is a new event loop, so it gets its own embed model (and AsyncOpenAI
+    # client) rather than sharing the server loop's; the client is reused across its batches
+    embed_model = OpenAIEmbedding(embed_batch_size=EMBED_BATCH_SIZE)
+    embeddings = asyncio.run(aembed_texts(embed_model, texts))
+    for node, embedding in zip(nodes, embeddings):
+        node.embedding = embedding
+
+async def insert_nodes(nodes):
+    index.insert_nodes(nodes)
+
+def index_directory(directory, loop):
+    # only files listed now are indexed and deleted; later arrivals wait for the next pass
+    snapshots = {}
+    for file_path in list_files(directory):
+        snapshot = file_snapshot(file_path)
+        if snapshot is not None:
+            snapshots[file_path] = snapshot
+    if not snapshots:
+        return
+    file_paths = list(snapshots)
+    digests = claim_upload_digests(file_paths)
+    logger.info("Indexing %d files in %s", len(file_paths), directory)
+
+    try:
+        documents = SimpleDirectoryReader(input_files=file_paths).load_data()
+        # new_index = VectorStoreIndex.from_documents(documents)
+        #     # store it for later
+        # new_index.storage_context.persist(persist_dir=PERSIST_DIR)
+
+        nodes = node_parser.get_nodes_from_documents(documents)
+        new_chunks = filter_new_chunks(nodes)
+        new_nodes = list(new_chunks.values())
+        logger.info("Skipping %d already indexed chunks.", len(nodes) - len(new_nodes))
+
+        if new_nodes:
             # Add nodes to the existing index
-            print("Adding new nodes to the existing index...")
-            index.insert_nodes(new_nodes)
+            logger.info("Adding %d new nodes to the existing index...", len(new_nodes))
+            embed_nodes(new_nodes)
+            # retrieval looks up vector store hits in the docstore without yielding, so inserting
+            # on the server loop means a query never sees vectors whose nodes are not stored yet;
+            # persist only reads the stores and may stay on this thread
+            asyncio.run_coroutine_threadsafe(insert_nodes(new_nodes), loop).result()
             index.storage_context.persist(persist_dir=PERSIST_DIR)
-            query_engine = index.as_query_engine()
-
-            delete_all_files_in_directory(directory)
-            print("Indexing Done.")
-
-        # else:
-        #     print(".")
-        time.sleep(interval)
+            indexed_chunk_hashes.update(new_chunks)
+            # query_engine and retriever read the live index, so only cached answers go stale
+            clear_query_cache()
+        indexed = True
+    except Exception:
+        logger.exception("Indexing failed for %s", file_paths)
+        indexed = False
+
+    # a file re-uploaded under the same name mid-pass may not be what was indexed; leave it
+    unchanged_paths = {
+        file_path for file_path, snapshot in snapshots.items()
+        if file_snapshot(file_path) == snapshot
+    }
+    settle_upload_digests(digests, unchanged_paths, indexed)
+    delete_files(unchanged_paths)
+    if indexed:
+        logger.info("Indexing Done.")
+
+# ---- index the drop directory when files land in it ----
+INDEX_DEBOUNCE = 1  # seconds
+
+index_requests = Queue()
+
+class DropDirectoryHandler(FileSystemEventHandler):
+    def on_created(self, event):
+        self.notify(event)
+
+    def on_modified(self, event):
+        self.notify(event)
+
+    def on_moved(self, event):
+        self.notify(event)
+
+    def notify(self, event):
+        if not event.is_directory:
+            index_requests.put(event)
+
+def index_on_change(directory, loop):
+    # the first pass picks up files dropped while the service was down
+    while True:
+        try:
+            index_directory(directory, loop)
+        except Exception:
+            # e.g. saving the upload digests failed; unsettled files stay for the next pass
+            logger.exception("Indexing pass failed for %s", directory)
+        index_requests.get()
+        # wait until the directory is quiet so a burst of uploads is indexed in one pass
+        while True:
+            try:
+                index_requests.get(timeout=INDEX_DEBOUNCE)
+            except Empty:
+                break
 
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
+    os.makedirs(drop_directory, exist_ok=True)
+    os.makedirs(staging_directory, exist_ok=True)
 
-    interval = 10
-    thread = Thread(target=index_periodically, args=(drop_directory, interval))
+    observer = Observer()
+    observer.schedule(DropDirectoryHandler(), drop_directory)
+    observer.start()
+
+    thread = Thread(target=index_on_change, args=(drop_directory, asyncio.get_running_loop()))
     thread.start()
 
 
@@ -203,8 +513,6 @@ http POST http://localhost:8000/retrieve query="최근에 오픈ai가 얼마를
 
 """
 
-import uvicorn
-
 if __name__ == "__main__":
     uvicorn.run("memento-service:app", host="0.0.0.0", port=8005, log_level="info")
 